@@ -1,17 +1,78 @@
+import json
+import os
 from typing import Optional
 
+import numpy as np
 import pytorch_lightning as pl
-from datasets import load_dataset, concatenate_datasets, ClassLabel
+from datasets import load_dataset, load_from_disk, concatenate_datasets, ClassLabel, Sequence, Value
 from pytorch_lightning.utilities.cli import DATAMODULE_REGISTRY
 from torch.utils.data import DataLoader
 from transformers import AutoTokenizer, PreTrainedTokenizerBase, DataCollatorWithPadding
 
 from src.constants import HEURISTIC_TO_INTEGER, SampleType
+from src.dataset.sampler import BucketBatchSampler
 from src.model.nlitransformer import PRETRAINED_MODEL_ID
-from src.utils.util import get_logger
+from src.utils.util import get_logger, ensure_dir
 
 log = get_logger(__name__)
 
+TOKENIZED_CACHE_VERSION = 6
+
+
+# The batch processing functions are module-level functions that receive the tokenizer through `fn_kwargs`,
+# so that the `num_proc` workers of `Dataset.map` do not need to pickle the datamodule and the trainer attached to it.
+def _tokenize_pairs(batch, tokenizer: PreTrainedTokenizerBase):
+    # padding is left to the collator so that every batch is only padded to its longest datapoint
+    res = tokenizer(
+        batch['premise'],
+        batch['hypothesis'],
+        truncation=True,
+        max_length=tokenizer.model_max_length,
+        padding=False,
+        return_token_type_ids=True,
+        return_attention_mask=True,
+    )
+    res['length'] = [len(input_ids) for input_ids in res['input_ids']]
+    return res
+
+
+def _process_hans(batch, tokenizer: PreTrainedTokenizerBase):
+    res = _tokenize_pairs(batch, tokenizer)
+    res['heuristic'] = [HEURISTIC_TO_INTEGER[sample] for sample in batch['heuristic']]
+    res['type'] = [SampleType.HEURISTIC_E.value if (sample == 0) else SampleType.HEURISTIC_NE.value
+                   for sample in batch['label']]
+    return res
+
+
+def _process_mnli(batch, tokenizer: PreTrainedTokenizerBase):
+    # the overlap heuristic is computed on the untruncated sentences so that the sample
+    # types do not depend on the tokenizer's max length, both sentences go in a single call
+    num_samples = len(batch['premise'])
+    sentences_ids = tokenizer(batch['premise'] + batch['hypothesis'], add_special_tokens=False)['input_ids']
+    premises_ids, hypotheses_ids = sentences_ids[:num_samples], sentences_ids[num_samples:]
+
+    types = []
+    for premise, hypothesis, label, premise_ids, hypothesis_ids in zip(
+            batch['premise'], batch['hypothesis'], batch['label'], premises_ids, hypotheses_ids
+    ):
+        sample_type = SampleType.STANDARD
+        if premise == hypothesis:
+            sample_type = SampleType.TRIVIAL if label == 0 else SampleType.NOISE
+        elif frozenset(hypothesis_ids).issubset(frozenset(premise_ids)):
+            sample_type = SampleType.HEURISTIC_E if label == 0 else SampleType.HEURISTIC_NE
+        types.append(sample_type.value)
+
+    res = _tokenize_pairs(batch, tokenizer)
+    res['type'] = types
+    return res
+
+
+def _num_available_cpus() -> int:
+    # only the cores available to this process, e.g. the ones allocated to a SLURM job
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
 
 @DATAMODULE_REGISTRY
 class ExperimentDataModule(pl.LightningDataModule):
@@ -24,7 +85,8 @@ class ExperimentDataModule(pl.LightningDataModule):
             batch_size: int,
             num_hans_train_examples: int = 0,
             num_workers: int = 4,
-            tokenizer_model_max_length: int = 512
+            tokenizer_model_max_length: int = 512,
+            cache_dir: str = os.path.join("data", "tokenized"),
     ):
         super().__init__()
 
@@ -33,6 +95,7 @@ class ExperimentDataModule(pl.LightningDataModule):
         self.num_workers = num_workers
         self.tokenizer_str = PRETRAINED_MODEL_ID
         self.tokenizer_model_max_length = tokenizer_model_max_length
+        self.cache_dir = cache_dir
 
         # attributes that may be downloaded and are initialized
         # in prepare data
@@ -41,55 +104,103 @@ class ExperimentDataModule(pl.LightningDataModule):
         self.mnli_dataset = None
         self.collator = None
 
-    def prepare_data(self):
-        load_dataset("hans", split='train')
-        load_dataset("hans", split='validation')
-        load_dataset("multi_nli")
-
-    def _process_mnli(self, sample):
-        sample_type = SampleType.STANDARD
-        if sample['premise'] == sample['hypothesis']:
-            sample_type = SampleType.TRIVIAL if sample['label'] == 0 else SampleType.NOISE
-        else:
-            tokenized_premise = self.tokenizer(sample['premise'], add_special_tokens=False)['input_ids']
-            tokenized_hypothesis = self.tokenizer(sample['hypothesis'], add_special_tokens=False)['input_ids']
-            if all(token in tokenized_premise for token in tokenized_hypothesis):
-                sample_type = SampleType.HEURISTIC_E if sample['label'] == 0 else SampleType.HEURISTIC_NE
+    @property
+    def _fingerprint(self):
+        """
+        Everything the tokenized datasets cached in `self.cache_dir` depend on.
+        Bump `TOKENIZED_CACHE_VERSION` whenever the preprocessing itself changes.
+        """
+        return {
+            "version": TOKENIZED_CACHE_VERSION,
+            "tokenizer": self.tokenizer_str,
+            "tokenizer_model_max_length": self.tokenizer_model_max_length,
+        }
 
-        new_attributes = {'type': sample_type.value}
-        new_attributes.update(self.tokenizer(sample['premise'], sample['hypothesis']))
+    def _cache_path(self, name):
+        return os.path.join(self.cache_dir, name)
 
-        return new_attributes
+    def _is_cache_valid(self):
+        fingerprint_path = self._cache_path("fingerprint.json")
+        if not os.path.exists(fingerprint_path):
+            return False
+        with open(fingerprint_path) as f:
+            return json.load(f) == self._fingerprint
 
-    def setup(self, stage: str):
-        self.tokenizer: PreTrainedTokenizerBase = AutoTokenizer.from_pretrained(self.tokenizer_str)
+    def _load_tokenizer(self):
+        self.tokenizer: PreTrainedTokenizerBase = AutoTokenizer.from_pretrained(self.tokenizer_str, use_fast=True)
+        assert self.tokenizer.is_fast, "A fast (Rust) tokenizer is required for batched preprocessing"
         self.tokenizer.model_max_length = self.tokenizer_model_max_length
 
+    def prepare_data(self):
+        if self._is_cache_valid():
+            log.info(f"Tokenized datasets found in cache: {self.cache_dir}")
+            return
+
+        log.info(f"Tokenizing datasets and caching them to: {self.cache_dir}")
+        self._load_tokenizer()
+
         # note that this batch size is the processing batch size for tokenization,
         # not the training batch size, I used the same because I'm lazy
+        hans_dataset_validation = load_dataset("hans", split='validation').map(
+            _process_hans,
+            batched=True,
+            batch_size=self.batch_size,
+            fn_kwargs={"tokenizer": self.tokenizer},
+        )
 
-        def tokenize_hans(batch):
-            res = self.tokenizer(
-                batch['premise'],
-                batch['hypothesis']
-            )
-            res['heuristic'] = [HEURISTIC_TO_INTEGER[sample] for sample in batch['heuristic']]
-            res['type'] = [SampleType.HEURISTIC_E.value if (sample == 0) else SampleType.HEURISTIC_NE.value
-                           for sample in batch['label']]
-            return res
-
-        self.hans_dataset_validation = load_dataset("hans", split='validation').map(
-            tokenize_hans,
+        hans_dataset_train = load_dataset("hans", split='train').map(
+            _process_hans,
             batched=True,
             batch_size=self.batch_size,
+            fn_kwargs={"tokenizer": self.tokenizer},
         )
+        # rename features to match MNLI
+        hans_dataset_train = hans_dataset_train.cast_column(
+            'label',
+            ClassLabel(num_classes=3, names=['entailment', 'neutral', 'contradiction'])
+        )
+
+        mnli_dataset = load_dataset("multi_nli").map(
+            _process_mnli,
+            batched=True,
+            batch_size=1000,
+            num_proc=_num_available_cpus(),
+            fn_kwargs={"tokenizer": self.tokenizer},
+        )
+
+        hans_dataset_validation = self._cast_to_compact_dtypes(hans_dataset_validation)
+        hans_dataset_train = self._cast_to_compact_dtypes(hans_dataset_train)
+        mnli_dataset = self._cast_to_compact_dtypes(mnli_dataset)
+
+        ensure_dir(self.cache_dir)
+        hans_dataset_validation.save_to_disk(self._cache_path("hans_validation"))
+        hans_dataset_train.save_to_disk(self._cache_path("hans_train"))
+        mnli_dataset.save_to_disk(self._cache_path("multi_nli"))
+
+        # the fingerprint is written last so that an interrupted run is not mistaken for a valid cache
+        with open(self._cache_path("fingerprint.json"), "w") as f:
+            json.dump(self._fingerprint, f, indent=2)
+
+    @staticmethod
+    def _cast_to_compact_dtypes(dataset):
+        # token ids fit into int32 and the token types and attention mask into int8, this only shrinks
+        # the cache on disk and in the page cache as the torch formatter still returns int64 tensors
+        return dataset \
+            .cast_column('input_ids', Sequence(Value('int32'))) \
+            .cast_column('token_type_ids', Sequence(Value('int8'))) \
+            .cast_column('attention_mask', Sequence(Value('int8')))
+
+    def setup(self, stage: str):
+        self._load_tokenizer()
+
+        self.hans_dataset_validation = load_from_disk(self._cache_path("hans_validation"))
         self.hans_dataset_validation.set_format(
             type='torch',
             columns=['input_ids', 'token_type_ids', 'attention_mask', 'label', 'heuristic']
         )
         log.info(f"Hans validation dataset loaded, datapoints: {len(self.hans_dataset_validation)}")
 
-        self.mnli_dataset = load_dataset("multi_nli").map(self._process_mnli)
+        self.mnli_dataset = load_from_disk(self._cache_path("multi_nli"))
         self.mnli_dataset.set_format(
             type='torch',
             columns=['input_ids', 'token_type_ids', 'attention_mask', 'label', 'type']
@@ -99,25 +210,14 @@ class ExperimentDataModule(pl.LightningDataModule):
         log.info(f"   len(self.mnli_dataset['validation_matched'])={len(self.mnli_dataset['validation_matched'])}")
 
         if (self.num_hans_train_examples > 0):
-            hans_dataset_train = load_dataset("hans", split='train').map(
-                tokenize_hans,
-                batched=True,
-                batch_size=self.batch_size,
-            )
-
-            # rename features to match MNLI
-            features = hans_dataset_train.features.copy()
-            features['label'] = ClassLabel(num_classes=3, names=['entailment', 'neutral', 'contradiction'])
-            hans_dataset_train = hans_dataset_train.map(
-                lambda batch: batch,
-                batched=True,
-                batch_size=self.batch_size,
-                features=features
-            )
+            hans_dataset_train = load_from_disk(self._cache_path("hans_train"))
             log.info(f"Hans train dataset loaded, datapoints: {len(hans_dataset_train)}")
 
-            hans_dataset_train = hans_dataset_train.shuffle()
-            hans_dataset_train = hans_dataset_train.select(range(self.num_hans_train_examples))
+            # draw the subset directly instead of shuffling the whole split first,
+            # the generator is seeded from numpy's global state set by `pl.seed_everything`
+            rng = np.random.default_rng(np.random.randint(2 ** 31))
+            indices = rng.choice(len(hans_dataset_train), self.num_hans_train_examples, replace=False)
+            hans_dataset_train = hans_dataset_train.select(indices.tolist())
             self.mnli_dataset['train'] = concatenate_datasets([self.mnli_dataset['train'], hans_dataset_train])
 
             self.mnli_dataset.set_format(
@@ -128,23 +228,40 @@ class ExperimentDataModule(pl.LightningDataModule):
             log.info(f"HANS training examples added to the MNLI training dataset splits loaded:")
             log.info(f"   len(self.mnli_dataset['train'])={len(self.mnli_dataset['train'])}")
 
-        self.collator = DataCollatorWithPadding(self.tokenizer, padding='longest', return_tensors="pt")
+        # padding to a multiple of 8 keeps the sequence dimension aligned with the tensor core tiles
+        self.collator = DataCollatorWithPadding(self.tokenizer, padding='longest', return_tensors="pt",
+                                                pad_to_multiple_of=8)
         self.collator_fn = lambda x: self.collator(x).data
 
+    def _dataloader_kwargs(self, persistent_workers: bool):
+        kwargs = {
+            "num_workers": self.num_workers,
+            "pin_memory": True,
+            "collate_fn": self.collator_fn,
+        }
+        # these options are only valid when loading with worker processes
+        if self.num_workers > 0:
+            kwargs["persistent_workers"] = persistent_workers
+            kwargs["prefetch_factor"] = 2
+        return kwargs
+
     def train_dataloader(self):
+        # the cached lengths are used to group training datapoints of similar length into the same batch
+        train_lengths = self.mnli_dataset['train'].with_format(None)['length']
         return DataLoader(self.mnli_dataset['train'],
-                          batch_size=self.batch_size,
-                          shuffle=True,
-                          collate_fn=self.collator_fn)  # type:ignore
+                          batch_sampler=BucketBatchSampler(train_lengths, self.batch_size),
+                          **self._dataloader_kwargs(persistent_workers=True))  # type:ignore
 
     def val_dataloader(self):
+        # validation workers are not kept alive between the validation runs
+        # so that they do not hold resources during training
         mnli_val_dataloader = DataLoader(self.mnli_dataset['validation_matched'],
                                          batch_size=self.batch_size,
-                                         collate_fn=self.collator_fn)  # type:ignore
+                                         **self._dataloader_kwargs(persistent_workers=False))  # type:ignore
 
         hans_dataloader = DataLoader(self.hans_dataset_validation,
                                      batch_size=self.batch_size,
-                                     collate_fn=self.collator_fn)  # type:ignore
+                                     **self._dataloader_kwargs(persistent_workers=False))  # type:ignore
         return [mnli_val_dataloader, hans_dataloader]
 
     def teardown(self, stage: Optional[str] = None):
@@ -0,0 +1,52 @@
+from typing import Iterator, List, Sequence
+
+import torch
+from torch.utils.data import Sampler
+
+
+class BucketBatchSampler(Sampler[List[int]]):
+    """
+    Batch sampler that puts datapoints of similar length into the same batch,
+    which reduces the amount of padding added by the collator.
+
+    Every epoch, the indices are shuffled and split into buckets of
+    `batch_size * bucket_size_multiplier` datapoints. Each bucket is sorted by
+    length and cut into batches, and the order of all batches is shuffled again
+    so that the batch length does not depend on the position in the epoch.
+    """
+
+    def __init__(self, lengths: Sequence[int], batch_size: int, bucket_size_multiplier: int = 50,
+                 drop_last: bool = False):
+        """
+        :param lengths: The length of every datapoint in the dataset.
+        :param batch_size: The number of datapoints per batch.
+        :param bucket_size_multiplier: How many batches fit in a single bucket.
+        :param drop_last: Whether to drop the batches that have less than `batch_size` datapoints.
+        """
+        super().__init__(None)
+
+        assert batch_size > 0 and bucket_size_multiplier > 0
+
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.bucket_size = batch_size * bucket_size_multiplier
+        self.drop_last = drop_last
+
+    def __iter__(self) -> Iterator[List[int]]:
+        indices = torch.randperm(len(self.lengths)).tolist()
+
+        batches = []
+        for bucket_start in range(0, len(indices), self.bucket_size):
+            bucket = sorted(indices[bucket_start:bucket_start + self.bucket_size], key=lambda i: self.lengths[i])
+            for batch_start in range(0, len(bucket), self.batch_size):
+                batch = bucket[batch_start:batch_start + self.batch_size]
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(batch)
+
+        for batch_idx in torch.randperm(len(batches)).tolist():
+            yield batches[batch_idx]
+
+    def __len__(self) -> int:
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
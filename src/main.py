@@ -37,10 +37,15 @@ def get_parser_main_model():
     parser.add_argument('--num_workers', type=int, default=20, help='number of dataloader workers')
     parser.add_argument('--batch_size', type=int, default=32, help='batch size')
     parser.add_argument('--gpus', type=int, default=-1)
-    parser.add_argument('--precision', type=int, default=16)
+    parser.add_argument('--precision', type=lambda p: p if p == 'bf16' else int(p), default=16,
+                        choices=[16, 32, 64, 'bf16'],
+                        help='training precision, bf16 (opt-in) uses bfloat16 mixed precision and needs a single GPU '
+                             'with native bf16 support')
     parser.add_argument('--early_stopping_patience', type=int, default=50)
     parser.add_argument('--accumulate_grad_batches', type=int, default=4)
     parser.add_argument('--num_hans_train_examples', type=int, default=0, help='number of HANS train examples')
+    parser.add_argument('--data_cache_dir', type=str, default='data/tokenized',
+                        help='directory where the tokenized datasets are cached')
 
     # model hparams
     parser.add_argument('--bert_hidden_dropout_prob', type=float, default=0.1,
@@ -79,6 +84,7 @@ def main(config):
         num_hans_train_examples=config.num_hans_train_examples,
         num_workers=config.num_workers,
         tokenizer_model_max_length=config.tokenizer_model_max_length,
+        cache_dir=config.data_cache_dir,
     )
 
     # 2. Prepare loggers
@@ -134,6 +140,16 @@ def main(config):
 
     # 5. Run
     if torch.cuda.is_available() and config.gpus != 0:
+        if config.precision == 'bf16':
+            # DataParallel re-enables autocast in each replica with the default fp16 dtype,
+            # so bf16 would silently run the replicas in fp16 without any loss scaling
+            num_gpus = torch.cuda.device_count() if config.gpus == -1 else config.gpus
+            if num_gpus > 1:
+                raise ValueError(f"bf16 precision is not supported with the dp strategy on {num_gpus} GPUs, "
+                                 f"use --precision 16 or --gpus 1")
+            if not torch.cuda.is_bf16_supported():
+                log.warning("bf16 precision was requested, but the GPU has no native bf16 support")
+
         trainer = Trainer(
             max_epochs=config.n_epochs,
             default_root_dir="logs",
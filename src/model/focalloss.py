@@ -21,8 +21,13 @@ class FocalLoss(nn.Module):
         self.gamma = gamma
         self.reduction = reduction
 
-    def forward(self, input_logits: torch.Tensor, onehot_targets: torch.Tensor):
-        ce_loss = torch.nn.functional.cross_entropy(input_logits, onehot_targets, reduction='none')
+    def forward(self, input_logits: torch.Tensor, targets: torch.Tensor):
+        """
+        :param input_logits: Unnormalized class scores of shape `(batch_size, num_classes)`.
+        :param targets: Target class indices of shape `(batch_size,)`.
+        """
+        log_probs = F.log_softmax(input_logits, dim=-1)
+        ce_loss = -log_probs.gather(dim=-1, index=targets.unsqueeze(-1)).squeeze(-1)
         input_probs_for_target = torch.exp(-ce_loss)
         loss = (1 - input_probs_for_target) ** self.gamma * ce_loss
 
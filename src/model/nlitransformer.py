@@ -1,14 +1,12 @@
-import io
+import concurrent.futures
+import functools
 import json
 import os
 
+import numpy as np
 import pandas as pd
-import seaborn as sns
 import torch
-import torch.nn.functional as F
 import wandb
-from PIL import Image
-from matplotlib import pyplot as plt
 from pytorch_lightning import LightningModule
 from pytorch_lightning.loggers import WandbLogger
 from torch.optim import AdamW, Adam
@@ -24,6 +22,22 @@ PRETRAINED_MODEL_ID = "bert-base-uncased"
 
 log = get_logger(__name__)
 
+# lookup tables used to map integer ids to readable names in the logged dataframes
+SAMPLE_TYPE_NAMES = np.array([SampleType(i).name.title() for i in range(len(SampleType))], dtype=object)
+HEURISTIC_NAMES = np.array(
+    [name.title().replace("_", " ") for name, _ in sorted(HEURISTIC_TO_INTEGER.items(), key=lambda item: item[1])],
+    dtype=object
+)
+
+# HANS metrics are aggregated per (label, heuristic) cell, indexed as `label * num_heuristics + heuristic`
+assert sorted(HEURISTIC_TO_INTEGER.values()) == list(range(len(HEURISTIC_TO_INTEGER)))
+HANS_LABEL_DESCRIPTIONS = ["entailment", "non_entailment"]
+HANS_METRIC_CELLS = [
+    (target_label * len(HEURISTIC_TO_INTEGER) + heuristic_idx, f"{label_description}_{heuristic_name}")
+    for target_label, label_description in enumerate(HANS_LABEL_DESCRIPTIONS)
+    for heuristic_name, heuristic_idx in HEURISTIC_TO_INTEGER.items()
+]
+
 
 class BertForNLI(LightningModule):
     """
@@ -61,6 +75,16 @@ class BertForNLI(LightningModule):
 
         # initialized in self.setup()
         self.loss_criterion = FocalLoss(self.hparams.focal_loss_gamma)
+        self._io_executor = None
+
+    def setup(self, stage=None):
+        # single background thread that writes and uploads the epoch end results
+        self._io_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def teardown(self, stage=None):
+        if self._io_executor is not None:
+            self._io_executor.shutdown(wait=True)
+            self._io_executor = None
 
     def forward(self, input_ids, attention_mask, token_type_ids, label=None, **kwargs) -> SequenceClassifierOutput:
         output: SequenceClassifierOutput = self.bert.forward(
@@ -73,9 +97,10 @@ class BertForNLI(LightningModule):
     def mnli_step(self, batch):
         output = self.forward(**batch)
 
-        onehot_labels = F.one_hot(batch["labels"], num_classes=3).float()
-        loss = self.loss_criterion(output.logits, onehot_labels)
-        preds = output.logits.argmax(dim=-1)
+        # the loss is computed in fp32 even when training in mixed precision
+        logits = output.logits.float()
+        loss = self.loss_criterion(logits, batch["labels"])
+        preds = logits.argmax(dim=-1)
         true_preds = (preds == batch["labels"]).float()
 
         results = {
@@ -91,9 +116,10 @@ class BertForNLI(LightningModule):
     def hans_step(self, batch):
         output = self.forward(**batch)
 
-        onehot_labels = F.one_hot(batch["labels"], num_classes=3).float()
-        loss = self.loss_criterion(output.logits, onehot_labels)
-        preds = output.logits.argmax(dim=-1)
+        # the loss is computed in fp32 even when training in mixed precision
+        logits = output.logits.float()
+        loss = self.loss_criterion(logits, batch["labels"])
+        preds = logits.argmax(dim=-1)
         labels = batch["labels"]
         heuristic = batch["heuristic"]
 
@@ -131,15 +157,18 @@ class BertForNLI(LightningModule):
 
         return results
 
+    @functools.cached_property
+    def _debug_tokenizer(self) -> PreTrainedTokenizerBase:
+        return AutoTokenizer.from_pretrained(PRETRAINED_MODEL_ID)
+
     def _log_batch_for_debugging(self, log_key, batch):
         def jsonify(value):
             if isinstance(value, torch.Tensor):
                 return value.tolist()
             return value
 
-        debug_tokenizer: PreTrainedTokenizerBase = AutoTokenizer.from_pretrained(PRETRAINED_MODEL_ID)
         batch = dict(batch)  # do not modify the original batch dict
-        batch["txt"] = debug_tokenizer.batch_decode(batch["input_ids"])
+        batch["txt"] = self._debug_tokenizer.batch_decode(batch["input_ids"])
 
         batch_json = json.dumps({k: jsonify(v) for k, v in batch.items()})
         log.info(f"{log_key}:\n{batch_json}")
@@ -150,91 +179,153 @@ class BertForNLI(LightningModule):
                 logger: WandbLogger = logger
                 logger.log_text(f"{log_key}", dataframe=batch_df)
 
-    @staticmethod
-    def log_plot_to_wandb(wandb_logger, log_key, backend=plt, dpi=200):
-        with io.BytesIO() as f:
-            backend.savefig(f, dpi=dpi, format='png')
-            im = Image.open(f)
-            wandb_logger.log({log_key: wandb.Image(im)})
-
-    def _log_loss_histogram(self, losses, split, metric_name, log_df=False, bins=72, height=4.5, dpi=200):
-        df = pd.DataFrame({metric_name: losses})
-        grid = sns.displot(data=df, x=metric_name, height=height, bins=bins)
-        grid.fig.suptitle(f"[Epoch {self.current_epoch}] {split} {metric_name} histogram", fontsize=16)
-        grid.set_titles(col_template="{col_name}", row_template="{row_name}")
-        grid.tight_layout()
+    def _log_loss_histogram(self, losses, split, metric_name, log_df=False, bins=72):
+        histogram = wandb.Histogram(np_histogram=np.histogram(losses, bins=bins))
 
         for logger in self.loggers:
             if isinstance(logger, WandbLogger):
-                logger.experiment.log({f'{split}/Verbose/{metric_name}_histogram': wandb.Histogram(losses)})
-                self.log_plot_to_wandb(logger.experiment, f'{split}/Verbose/{metric_name}_histogram_seaborn',
-                                       backend=grid, dpi=dpi)
+                logger.experiment.log({f'{split}/Verbose/{metric_name}_histogram': histogram})
                 if log_df:
-                    logger.experiment.log({f"{split}/Verbose/{metric_name}_df": df})
-
-        plt.close()
+                    logger.experiment.log({f"{split}/Verbose/{metric_name}_df": pd.DataFrame({metric_name: losses})})
 
     def _log_mnli_metrics_per_sample_type(self, prefix: str, types, losses, true_preds):
+        num_types = len(SampleType)
+        loss_sums = np.bincount(types, weights=losses, minlength=num_types)
+        true_preds_sums = np.bincount(types, weights=true_preds, minlength=num_types)
+        counts = np.bincount(types, minlength=num_types)
+
         for sample_type in SampleType:
-            mask = types == sample_type.value
-            loss_per_type = losses[mask].mean()
-            acc_per_type = true_preds[mask].mean()
+            if counts[sample_type.value] == 0:
+                # that way we avoid NaN and polluting our metrics
+                continue
+
+            loss_per_type = loss_sums[sample_type.value] / counts[sample_type.value]
+            acc_per_type = true_preds_sums[sample_type.value] / counts[sample_type.value]
             self.log(f"{prefix}/mnli_{sample_type.name.lower()}_loss", loss_per_type, on_step=False, on_epoch=True,
                      prog_bar=True, logger=True)
             self.log(f"{prefix}/mnli_{sample_type.name.lower()}_accuracy", acc_per_type, on_step=False, on_epoch=True,
                      prog_bar=True, logger=True)
 
-    def _mnli_epoch_end(self, split: str, mnli_results):
-        types = torch.cat([x["mnli_datapoint_type"] for x in mnli_results]).detach().cpu().numpy()
-        losses = torch.cat([x["mnli_datapoint_loss"] for x in mnli_results]).detach().cpu().numpy()
-        true_preds = torch.cat([x["mnli_true_preds"] for x in mnli_results]).detach().cpu().numpy()
+    def _log_epoch_end_df(self, split: str, dataset_name: str, columns):
+        """
+        Log the per-datapoint epoch end results as a CSV artifact to wandb.
+        The DataFrame is built and uploaded on the IO thread so that training is not blocked.
+
+        :param split: The split the results belong to, e.g. `Train` or `Valid`.
+        :param dataset_name: The dataset the results belong to, e.g. `mnli` or `hans`.
+        :param columns: The columns of the DataFrame, the arrays should not be modified afterwards.
+        """
+        epoch, step = self.current_epoch, self.global_step
+        wandb_loggers = [logger for logger in self.loggers if isinstance(logger, WandbLogger)]
+
+        def flush():
+            df = pd.DataFrame({**columns, "epoch": epoch, "step": step})
+            # Log the dataframe to wandb
+            for logger in wandb_loggers:
+                csv_path = os.path.join(
+                    logger.experiment.dir,
+                    f"{split}_{dataset_name}_epoch_end_df_epoch-{epoch}_step-{step}.csv"
+                )
+                df.to_csv(csv_path)
+                artifact = wandb.Artifact(
+                    name=f"{logger.experiment.name}-{split}-{dataset_name}_epoch_end_df",
+                    type="df",
+                    metadata={"epoch": epoch, "step": step},
+                )
+                artifact.add_file(csv_path, "df.csv")
+                logger.experiment.log_artifact(artifact)
+
+        if self._io_executor is None:
+            flush()
+        else:
+            self._io_executor.submit(flush).add_done_callback(self._log_io_exception)
+
+    @staticmethod
+    def _log_io_exception(future: concurrent.futures.Future):
+        if future.exception() is not None:
+            log.error(f"Logging epoch end results failed: {future.exception()!r}")
+
+    @staticmethod
+    def _start_copy_to_host(tensor: torch.Tensor):
+        """
+        Start an asynchronous device-to-host copy of the given tensor into pinned memory.
+
+        :return: The host tensor and the CUDA event recorded after the copy, to be passed to `_wait_host_numpy`.
+        """
+        tensor = tensor.detach()
+        if not tensor.is_cuda:
+            return tensor, None
+
+        host_tensor = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+        host_tensor.copy_(tensor, non_blocking=True)
+        copy_done = torch.cuda.Event()
+        copy_done.record(torch.cuda.current_stream(tensor.device))
+        return host_tensor, copy_done
+
+    @staticmethod
+    def _wait_host_numpy(staged_copy) -> np.ndarray:
+        """
+        Wait only for the given copy started by `_start_copy_to_host` and return the copied data.
+        """
+        host_tensor, copy_done = staged_copy
+        if copy_done is not None:
+            copy_done.synchronize()
+        return host_tensor.numpy()
+
+    def _start_mnli_copy_to_host(self, mnli_results):
+        # stack everything into a single tensor so that only one device-to-host copy is made
+        return self._start_copy_to_host(torch.stack([
+            torch.cat([x["mnli_datapoint_type"] for x in mnli_results]).float(),
+            torch.cat([x["mnli_datapoint_loss"] for x in mnli_results]).float(),
+            torch.cat([x["mnli_true_preds"] for x in mnli_results]).float(),
+        ], dim=1))
+
+    def _mnli_epoch_end(self, split: str, mnli_staged_copy):
+        results = self._wait_host_numpy(mnli_staged_copy)
+        types = results[:, 0].astype(np.int64)
+        losses = results[:, 1]
+        true_preds = results[:, 2]
 
         self._log_mnli_metrics_per_sample_type(split, types, losses, true_preds)
         self._log_loss_histogram(losses, split, "mnli_loss", log_df=False)
 
         # Create a DataFrame to be used in post-run logs processing to create visuals for the paper report
-        mnli_df = pd.DataFrame({
+        self._log_epoch_end_df(split, "mnli", {
             "type": types,
-            "type_str": [SampleType(t).name.title() for t in types],
+            "type_str": SAMPLE_TYPE_NAMES[types],
             "loss": losses,
             "true_preds": true_preds,
-            "epoch": self.current_epoch,
-            "step": self.global_step,
         })
-        # Log the dataframe to wandb
-        for logger in self.loggers:
-            if isinstance(logger, WandbLogger):
-                logger: WandbLogger = logger
-                csv_path = os.path.join(
-                    logger.experiment.dir,
-                    f"{split}_mnli_epoch_end_df_epoch-{self.current_epoch}_step-{self.global_step}.csv"
-                )
-                mnli_df.to_csv(csv_path)
-                artifact = wandb.Artifact(
-                    name=f"{logger.experiment.name}-{split}-mnli_epoch_end_df",
-                    type="df",
-                    metadata={"epoch": self.current_epoch, "step": self.global_step},
-                )
-                artifact.add_file(csv_path, "df.csv")
-                logger.experiment.log_artifact(artifact)
 
     def training_epoch_end(self, outputs):
         # MNLI
         mnli_results = outputs
-        self._mnli_epoch_end("Train", mnli_results)
+        self._mnli_epoch_end("Train", self._start_mnli_copy_to_host(mnli_results))
 
     def validation_epoch_end(self, outputs):
-        # MNLI
+        # Both copies are queued before any of them is waited for. The MNLI copy is queued first,
+        # so the HANS copy runs while the MNLI results are processed and logged.
         mnli_results = outputs[0]
-        self._mnli_epoch_end("Valid", mnli_results)
+        mnli_staged_copy = self._start_mnli_copy_to_host(mnli_results)
 
-        # HANS
         hans_results = outputs[1]
+        # stack everything into a single tensor so that only one device-to-host copy is made
+        hans_staged_copy = self._start_copy_to_host(torch.stack([
+            torch.cat([x["preds"] for x in hans_results]).float(),
+            torch.cat([x["labels"] for x in hans_results]).float(),
+            torch.cat([x["heuristic"] for x in hans_results]).float(),
+            torch.cat([x["hans_loss"] for x in hans_results]).float(),
+        ], dim=1))
 
-        preds = torch.cat([x["preds"] for x in hans_results]).detach().cpu().numpy()
-        labels = torch.cat([x["labels"] for x in hans_results]).detach().cpu().numpy()
-        heuristics = torch.cat([x["heuristic"] for x in hans_results]).detach().cpu().numpy()
-        losses = torch.cat([x["hans_loss"] for x in hans_results]).detach().cpu().numpy()
+        # MNLI
+        self._mnli_epoch_end("Valid", mnli_staged_copy)
+
+        # HANS
+        results = self._wait_host_numpy(hans_staged_copy)
+        preds = results[:, 0].astype(np.int64)
+        labels = results[:, 1].astype(np.int64)
+        heuristics = results[:, 2].astype(np.int64)
+        losses = results[:, 3]
         loss = losses.mean()
 
         acc = (preds == labels).sum() / len(preds)
@@ -243,53 +334,32 @@ class BertForNLI(LightningModule):
         self.log("Valid/hans_count", float(len(preds)), on_step=False, on_epoch=True, prog_bar=True, logger=True)
         self._log_loss_histogram(losses, "Valid", "hans_loss", log_df=False)
 
-        for target_label, label_description in enumerate(["entailment", "non_entailment"]):
-            for heuristic_name, heuristic_idx in HEURISTIC_TO_INTEGER.items():
-                mask = (heuristics == heuristic_idx) & (labels == target_label)
-                if mask.sum() == 0:
-                    # that way we avoid NaN and polluting our metrics
-                    continue
-
-                loss = losses[mask].mean()
-                acc = (preds[mask] == labels[mask]).mean()
-                self.log(f"Valid/Hans_loss/{label_description}_{heuristic_name}", loss, on_step=False, on_epoch=True,
-                         prog_bar=True,
-                         logger=True)
-                self.log(f"Valid/Hans_acc/{label_description}_{heuristic_name}", acc, on_step=False, on_epoch=True,
-                         prog_bar=True, logger=True)
+        num_cells = len(HANS_METRIC_CELLS)
+        cells = labels * len(HEURISTIC_TO_INTEGER) + heuristics
+        loss_sums = np.bincount(cells, weights=losses, minlength=num_cells)
+        true_preds_sums = np.bincount(cells, weights=(preds == labels), minlength=num_cells)
+        counts = np.bincount(cells, minlength=num_cells)
+
+        for cell, metric_suffix in HANS_METRIC_CELLS:
+            if counts[cell] == 0:
+                # that way we avoid NaN and polluting our metrics
+                continue
+
+            loss = loss_sums[cell] / counts[cell]
+            acc = true_preds_sums[cell] / counts[cell]
+            self.log(f"Valid/Hans_loss/{metric_suffix}", loss, on_step=False, on_epoch=True, prog_bar=True,
+                     logger=True)
+            self.log(f"Valid/Hans_acc/{metric_suffix}", acc, on_step=False, on_epoch=True, prog_bar=True,
+                     logger=True)
 
         # Create a DataFrame to be used in post-run logs processing to create visuals for the paper report
-        INTEGER_TO_HEURISTIC = {v: k.title().replace("_", " ") for k, v in HEURISTIC_TO_INTEGER.items()}
-        hans_df = pd.DataFrame({
+        self._log_epoch_end_df("Valid", "hans", {
             "preds": preds,
             "labels": labels,
             "heuristics": heuristics,
-            "heuristics_str": [INTEGER_TO_HEURISTIC[h] for h in heuristics],
+            "heuristics_str": HEURISTIC_NAMES[heuristics],
             "losses": losses,
-            "epoch": self.current_epoch,
-            "step": self.global_step,
         })
-        # Log the dataframe to wandb
-        for logger in self.loggers:
-            if isinstance(logger, WandbLogger):
-                logger: WandbLogger = logger
-                csv_path = os.path.join(
-                    logger.experiment.dir,
-                    f"Valid_hans_epoch_end_df_epoch-{self.current_epoch}_step-{self.global_step}.csv"
-                )
-                hans_df.to_csv(csv_path)
-                artifact = wandb.Artifact(
-                    name=f"{logger.experiment.name}-Valid-hans_epoch_end_df",
-                    type="df",
-                    metadata={"epoch": self.current_epoch, "step": self.global_step},
-                )
-                artifact.add_file(csv_path, "df.csv")
-                logger.experiment.log_artifact(artifact)
-        # # Log the dataframe to wandb
-        # for logger in self.loggers:
-        #     if isinstance(logger, WandbLogger):
-        #         logger: WandbLogger = logger
-        #         logger.experiment.log({f"Valid/Verbose/hans_epoch_end_df": hans_df})
 
     def configure_optimizers(self):
         """Prepare optimizer and schedule (linear warmup and decay)"""
@@ -0,0 +1,46 @@
+import unittest
+
+import torch
+
+from src.dataset.sampler import BucketBatchSampler
+
+
+class TestBucketBatchSampler(unittest.TestCase):
+    def test_every_index_sampled_once(self):
+        """
+        Test that one epoch of batches is a partition of the dataset indices.
+        """
+        lengths = torch.randint(low=1, high=128, size=(1003,)).tolist()
+        sampler = BucketBatchSampler(lengths, batch_size=16, bucket_size_multiplier=4)
+
+        batches = list(sampler)
+        self.assertEqual(len(sampler), len(batches))
+        self.assertEqual(sorted(i for batch in batches for i in batch), list(range(len(lengths))))
+        self.assertTrue(all(len(batch) <= 16 for batch in batches))
+
+    def test_drop_last(self):
+        """
+        Test that only full batches are returned when `drop_last` is set.
+        """
+        lengths = list(range(100))
+        sampler = BucketBatchSampler(lengths, batch_size=8, bucket_size_multiplier=100, drop_last=True)
+
+        batches = list(sampler)
+        self.assertEqual(len(sampler), len(batches))
+        self.assertTrue(all(len(batch) == 8 for batch in batches))
+
+    def test_batches_group_similar_lengths(self):
+        """
+        Test that a bucket covering the whole dataset yields batches of contiguous lengths.
+        """
+        lengths = torch.randperm(64).tolist()
+        sampler = BucketBatchSampler(lengths, batch_size=8, bucket_size_multiplier=8)
+
+        for batch in sampler:
+            batch_lengths = sorted(lengths[i] for i in batch)
+            self.assertEqual(batch_lengths[-1] - batch_lengths[0], 7)
+            self.assertEqual(batch_lengths[0] % 8, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()